@@ -1,27 +1,58 @@
-import asyncio, json, time
+# mypy: disallow-untyped-defs
+import asyncio, time
 
-import nio
+import aiofiles  # type: ignore[import-untyped]
+import aiohttp
+import nio  # type: ignore[import-untyped]
+import orjson
+import uvloop
+from nio.api import Api  # type: ignore[import-untyped]
 
 # Read .env
 from dotenv import dotenv_values
 
 environ = dotenv_values(".env")
 
+# Encode request bodies with orjson instead of the stdlib json module
+Api.to_json = staticmethod(lambda content: orjson.dumps(content).decode())
+
+# (second, formatted time) of the last log line
+_ts_cache: tuple[int, str] = (0, "")
+
 
 class MultiAccountBot:
-    async def log(self, message: str, room_id: str = None) -> None:
-        # GMT +8 time in YYYY-MM-DD HH:MM:SS format
-        message = f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}] {message}"
+    def log(self, message: str, room_id: str | None = None) -> None:
+        global _ts_cache
+        # GMT +8 time in YYYY-MM-DD HH:MM:SS format, formatted once per second
+        now = int(time.time())
+        if now != _ts_cache[0]:
+            _ts_cache = (now, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)))
+        message = f"[{_ts_cache[1]}] {message}"
         print(message)
-        resp = await self.client.room_send(
-            room_id=room_id or environ["LOG_ROOM"],
-            message_type="m.room.message",
-            content={"msgtype": "m.text", "body": message},
+        # Send in the background; errors are reported when the send completes
+        task = asyncio.create_task(
+            self.client.room_send(
+                room_id=room_id or self.log_room,
+                message_type="m.room.message",
+                content={"msgtype": "m.text", "body": message},
+            )
         )
-        if isinstance(resp, nio.ErrorResponse):
-            print(f"Error sending message: {resp.message}")
+        self._bg.add(task)
+        task.add_done_callback(self._log_done)
+
+    def _log_done(self, task: asyncio.Task) -> None:
+        self._bg.discard(task)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            print(f"Error sending message: {task.exception()}")
+        elif isinstance(task.result(), nio.ErrorResponse):
+            print(f"Error sending message: {task.result().message}")
 
-    def _check_config(self):
+    async def _flush_logs(self) -> None:
+        await asyncio.gather(*self._bg, return_exceptions=True)
+
+    def _check_config(self) -> None:
         if not environ.get("SERVER_URL"):
             raise ValueError("SERVER_URL not set in .env")
         if not environ.get("USER_ID"):
@@ -31,16 +62,47 @@ class MultiAccountBot:
         if not environ.get("LOG_ROOM"):
             raise ValueError("LOG_ROOM not set in .env")
 
-    async def _initialize_spaces(self):
+    async def _create_room(
+        self, name: str, space_id: str, via_domain: str, initial_state: list[dict]
+    ) -> nio.RoomCreateResponse:
+        room = await self.client.room_create(name=name, initial_state=initial_state)
+        if isinstance(room, nio.RoomCreateError):
+            raise RuntimeError(f"Error creating {name}: {room.message}")
+        # add to space as child room
+        await self._put_state(
+            space_id,
+            "m.space.child",
+            {
+                "suggested": True,
+                "via": [via_domain],
+            },
+            state_key=room.room_id,
+        )
+        return room
+
+    async def _put_state(
+        self, room_id: str, event_type: str, content: dict, state_key: str = ""
+    ) -> nio.RoomPutStateResponse:
+        resp = await self.client.room_put_state(
+            room_id, event_type, content, state_key=state_key
+        )
+        if isinstance(resp, nio.RoomPutStateError):
+            raise RuntimeError(
+                f"Error setting {event_type} in {room_id}: {resp.message}"
+            )
+        return resp
+
+    async def _initialize_spaces(self) -> None:
         resp = await self.client.room_create(space=True, name="Admin Space")
         if isinstance(resp, nio.RoomCreateError):
-            await self.log(f"Error creating room: {resp.message}")
+            self.log(f"Error creating room: {resp.message}")
+            await self._flush_logs()
             raise SystemExit(1)
 
-        await self.log(f"Created space with ID {resp.room_id}")
+        self.log(f"Created space with ID {resp.room_id}")
         space_id = resp.room_id
         self.config["ADMIN_SPACE"] = space_id
-        via_domain = space_id.split(":")[1]
+        via_domain = space_id.split(":", 1)[1]
         # create room with parent room
         initial_state = [
             {
@@ -52,154 +114,228 @@ class MultiAccountBot:
                 },
             }
         ]
-        # Create control room
-        room = await self.client.room_create(
-            name="Control Room", initial_state=initial_state
-        )
-        assert room.room_id is not None
-        # add to space as child room
-        state_update = await self.client.room_put_state(
-            space_id,
-            "m.space.child",
-            {
-                "suggested": True,
-                "via": [via_domain],
-            },
-            state_key=room.room_id,
-        )
-        assert state_update.event_id is not None
+        # Create control room. The log room updates don't depend on it, so
+        # submit them concurrently; a failure in any cancels the others.
+        try:
+            async with asyncio.TaskGroup() as tg:
+                control_room = tg.create_task(
+                    self._create_room(
+                        "Control Room", space_id, via_domain, initial_state
+                    )
+                )
+                # Move log room to space and rename it to "Log Room"
+                tg.create_task(
+                    self._put_state(
+                        space_id,
+                        "m.space.child",
+                        {
+                            "suggested": True,
+                            "via": [via_domain],
+                        },
+                        state_key=self.log_room,
+                    )
+                )
+                tg.create_task(
+                    self._put_state(
+                        self.log_room,
+                        "m.room.name",
+                        {"name": "Log Room"},
+                    )
+                )
+        except* RuntimeError as group:
+            for error in group.exceptions:
+                self.log(str(error))
+            await self._flush_logs()
+            raise SystemExit(1)
+        room = control_room.result()
         self.config["CONTROL_ROOM"] = room.room_id
-        await self.log(f"Created control room with ID {room.room_id}")
-
-        # Move log room to space and rename it to "Log Room"
-        await self.client.room_put_state(
-            space_id,
-            "m.space.child",
-            {
-                "suggested": True,
-                "via": [via_domain],
-            },
-            state_key=environ["LOG_ROOM"],
-        )
-        await self.client.room_put_state(
-            environ["LOG_ROOM"],
-            "m.room.name",
-            {"name": "Log Room"},
-        )
+        self.log(f"Created control room with ID {room.room_id}")
 
     def __init__(self) -> None:
         self._check_config()
+        log_room = environ["LOG_ROOM"]
+        assert log_room is not None
+        self.log_room: str = log_room
+        self.controller: str | None = environ.get("CONTROLLER")
         self.client = nio.AsyncClient(environ["SERVER_URL"], environ["USER_ID"])
+        self.config: dict = {}
+        self.begin_process: bool = False
+        # Events older than this were handled by a previous run
+        self._last_ts: int = 0
+        # Cap concurrent sends so crawls don't flood the homeserver
+        self._send_sem = asyncio.Semaphore(8)
+        # Joined room IDs, populated on first use and kept up to date by sync
+        self._joined_rooms: set[str] | None = None
+        # Pending fire-and-forget tasks, referenced so they aren't collected
+        self._bg: set[asyncio.Task] = set()
+        self._cmds = {
+            "!ping": self._cmd_ping,
+            "!exit": self._cmd_exit,
+            "!crawl": self._cmd_crawl,
+        }
+
+    async def _send_one(
+        self, message: nio.Event
+    ) -> nio.RoomSendResponse | nio.RoomSendError:
+        async with self._send_sem:
+            return await self.client.room_send(
+                self.log_room,
+                message_type="m.room.message",
+                content=message.source["content"],
+            )
+
+    async def sync_callback(self, response: nio.SyncResponse) -> None:
+        if self._joined_rooms is None:
+            return
+        # Rooms we joined, left, were kicked or banned from since the last sync
+        self._joined_rooms.update(response.rooms.join)
+        self._joined_rooms.difference_update(response.rooms.leave)
+
+    async def _load_config(self) -> None:
         try:
-            self.config: dict = json.load(open("config.json", "r", encoding="utf-8"))
+            async with aiofiles.open("config.json", "rb") as f:
+                self.config = orjson.loads(await f.read())
         except FileNotFoundError:
             self.config = {}
-        self.begin_process: bool = False
+        self._last_ts = int(self.config.get("LAST_TIMESTAMP", 0))
 
-    async def start(self):
+    async def _save_config(self) -> None:
+        async with aiofiles.open("config.json", "wb") as f:
+            await f.write(orjson.dumps(self.config))
+
+    async def start(self) -> None:
+        await self._load_config()
+        # Keep connections to the homeserver alive across bursts of requests
+        self.client.client_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=64, keepalive_timeout=120, ttl_dns_cache=600
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.client.config.request_timeout),
+        )
         print((await self.client.login(environ["PASSWORD"])).device_id)
         if not self.config.get("ADMIN_SPACE"):
-            await self.log("Creating admin space...")
+            self.log("Creating admin space...")
             # Create spaces
             await self._initialize_spaces()
-        if environ.get("CONTROLLER"):
+        if self.controller:
             # Invite controller to admin space
             await self.client.room_invite(
-                self.config.get("ADMIN_SPACE"), environ["CONTROLLER"]
+                self.config.get("ADMIN_SPACE"), self.controller
             )
 
         # Send timestamp
         self.timestamp = int(time.time() * 1000)
         await self.client.room_send(
-            environ["LOG_ROOM"],
+            self.log_room,
             "m.room.message",
             {"msgtype": "m.text", "body": f"Timestamp: {self.timestamp}"},
         )
         # Callback for messages
         self.client.add_event_callback(self.message_callback, nio.RoomMessageText)
+        self.client.add_response_callback(self.sync_callback, nio.SyncResponse)
         await self.client.sync_forever(timeout=30000)
 
     async def message_callback(
         self, current_room: nio.MatrixRoom, event: nio.RoomMessageText
-    ):
+    ) -> None:
         body = event.body
-        if event.server_timestamp < self.config.get("LAST_TIMESTAMP", 0):
+        if event.server_timestamp < self._last_ts:
             return
-        if (
-            body.startswith("Timestamp:")
-            and len(body.split(" ")) == 2
-            and current_room.room_id == environ["LOG_ROOM"]
-        ):
+        if body.startswith("Timestamp:") and current_room.room_id == self.log_room:
+            args = body.split(" ")
+            if len(args) != 2:
+                return
             try:
-                timestamp = int(body.split(" ")[1])
+                timestamp = int(args[1])
             except ValueError:
                 return
             if timestamp == self.timestamp:
-                self.config["LAST_TIMESTAMP"] = event.server_timestamp
+                self._last_ts = event.server_timestamp
+                self.config["LAST_TIMESTAMP"] = self._last_ts
                 self.begin_process = True
-                await self.log("Timestamp verified, starting process...")
+                self.log("Timestamp verified, starting process...")
             return
         if not self.begin_process:
             return
 
-        if current_room.room_id == self.config.get(
-            "CONTROL_ROOM"
-        ) and event.body.startswith("!"):
-            if body == "!ping":
-                await self.log("Pong!", room_id=current_room.room_id)
-            if body == "!exit":
-                await self.log("Exiting...", room_id=current_room.room_id)
-                await self.log("--- END OF BOT LOG ---")
-                await self.client.close()
-                # Write config
-                self.config["LAST_TIMESTAMP"] = event.server_timestamp
-                json.dump(self.config, open("config.json", "w", encoding="utf-8"))
-                raise SystemExit(0)
-            # If starts with !crawl
-            if body.startswith("!crawl"):
-                args = body.split(" ")
-                if len(args) != 3:
-                    await self.log(
-                        "Invalid arguments. Expected: !crawl <room_id> <num_messages>",
-                        room_id=current_room.room_id,
-                    )
-                    return
-                room_id = args[1]
-                num_messages = int(args[2])
-                if room_id not in (await self.client.joined_rooms()).rooms:
-                    await self.log("Not in room", room_id=current_room.room_id)
-                    return
-                await self.log(
-                    f"Crawling {num_messages} messages from {room_id}",
-                    room_id=current_room.room_id,
-                )
-                messages = await self.client.room_messages(
-                    room_id, start="", limit=num_messages
-                )
-                if isinstance(messages, nio.RoomMessagesError):
-                    await self.log(
-                        f"Error getting messages: {messages.message}",
-                        room_id=current_room.room_id,
-                    )
-                    return
-                for message in messages.chunk:
-                    # Check if message is a subtype of RoomMessage
-                    if str(type(message)).startswith(
-                        "<class 'nio.events.room_events.RoomMessage"
-                    ):
-                        await self.client.room_send(
-                            environ["LOG_ROOM"],
-                            message_type="m.room.message",
-                            content=message.source["content"],
-                        )
-                return
-            else:
-                await self.log(
+        if current_room.room_id == self.config.get("CONTROL_ROOM"):
+            cmd, _, rest = body.partition(" ")
+            handler = self._cmds.get(cmd)
+            if handler is not None:
+                await handler(current_room, event, rest)
+            elif cmd.startswith("!"):
+                self.log(
                     "Invalid command. Available commands: !ping, !exit, !crawl",
                     room_id=current_room.room_id,
                 )
 
+    async def _cmd_ping(
+        self, current_room: nio.MatrixRoom, event: nio.RoomMessageText, rest: str
+    ) -> None:
+        self.log("Pong!", room_id=current_room.room_id)
+
+    async def _cmd_exit(
+        self, current_room: nio.MatrixRoom, event: nio.RoomMessageText, rest: str
+    ) -> None:
+        self.log("Exiting...", room_id=current_room.room_id)
+        self.log("--- END OF BOT LOG ---")
+        await self._flush_logs()
+        await self.client.close()
+        # Write config
+        self._last_ts = event.server_timestamp
+        self.config["LAST_TIMESTAMP"] = self._last_ts
+        await self._save_config()
+        raise SystemExit(0)
+
+    async def _cmd_crawl(
+        self, current_room: nio.MatrixRoom, event: nio.RoomMessageText, rest: str
+    ) -> None:
+        args = rest.split(" ")
+        if len(args) != 2:
+            self.log(
+                "Invalid arguments. Expected: !crawl <room_id> <num_messages>",
+                room_id=current_room.room_id,
+            )
+            return
+        room_id = args[0]
+        num_messages = int(args[1])
+        if self._joined_rooms is None:
+            self._joined_rooms = set((await self.client.joined_rooms()).rooms)
+        if room_id not in self._joined_rooms:
+            self.log("Not in room", room_id=current_room.room_id)
+            return
+        self.log(
+            f"Crawling {num_messages} messages from {room_id}",
+            room_id=current_room.room_id,
+        )
+        messages = await self.client.room_messages(
+            room_id, start="", limit=num_messages
+        )
+        if isinstance(messages, nio.RoomMessagesError):
+            self.log(
+                f"Error getting messages: {messages.message}",
+                room_id=current_room.room_id,
+            )
+            return
+        # Sends run concurrently, so messages may arrive in the log room in a
+        # different order than they were crawled
+        send_one = self._send_one
+        tasks = [
+            send_one(message)
+            for message in messages.chunk
+            if isinstance(message, nio.RoomMessage)
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        failed = sum(
+            isinstance(result, (BaseException, nio.ErrorResponse)) for result in results
+        )
+        if failed:
+            self.log(
+                f"Failed to send {failed} of {len(results)} crawled messages",
+                room_id=current_room.room_id,
+            )
+
 
 if __name__ == "__main__":
     bot = MultiAccountBot()
-    asyncio.run(bot.start())
+    uvloop.run(bot.start())